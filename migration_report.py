@@ -1,9 +1,15 @@
 import os
+import csv
+import json
+import sqlite3
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pyxnat import Interface
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional
 import time
-import pandas as pd
 
 # ----------- CONFIGURATION -----------
 # This script uses pyxnat. pyxnat uses configuration files
@@ -14,26 +20,121 @@ import pandas as pd
 XNAT1_CFG = os.path.expanduser('~/xnat.cfg')
 XNAT2_CFG = os.path.expanduser('~/xnat2.cfg')
 MAX_WORKERS=16
+REQUEST_TIMEOUT=(5, 60) # (connect, read) seconds
+# Transient server errors are retried with exponential backoff before an experiment is reported as failed
+MAX_RETRIES=Retry(total=5, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504))
+# Optionally cache file statistics in CACHE_DB between runs, keyed by (experiment_id, last_modified),
+# so a rerun only queries XNAT1 for experiments that changed since the previous run.
+# Off by default: it relies on xnat:mrSessionData/LAST_MODIFIED changing whenever files are added
+# to or removed from a scan resource, which has not been confirmed on XNAT1. With it on, a stale
+# entry would be reported as a current count.
+USE_STATS_CACHE=False
+CACHE_DB = os.path.expanduser('~/.migration_report.cache.sqlite')
 # -------------------------------------
 
+# Each worker thread keeps one authenticated requests.Session per XNAT instance,
+# reused across every task that thread processes. Every session is also recorded in
+# _open_sessions so the main thread can log them all out once the pool has shut down.
+_thread_local = threading.local()
+_open_sessions = []
+_open_sessions_lock = threading.Lock()
+
+def get_thread_session(xnat_interface_config_path):
+    """
+    Returns (server, session) for the XNAT instance described by a pyxnat configuration file.
+    The session is created lazily the first time the calling thread asks for it, logs in once
+    via /data/JSESSION (the JSESSIONID cookie is kept in the session), and is then reused.
+    Credentials are also kept on the session, so if the JSESSIONID expires mid-run the next
+    request authenticates again instead of failing with a 401.
+    Requests made through the session retry transient failures according to MAX_RETRIES.
+    """
+    sessions = getattr(_thread_local, 'sessions', None)
+    if sessions is None:
+        sessions = _thread_local.sessions = {}
+
+    if xnat_interface_config_path not in sessions:
+        with open(xnat_interface_config_path) as f:
+            config = json.load(f)
+        server = config['server'].rstrip('/')
+        session = requests.Session()
+        session.verify = config.get('verify', True)
+        session.auth = (config['user'], config['password'])
+        adapter = HTTPAdapter(max_retries=MAX_RETRIES)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        response = session.post(f'{server}/data/JSESSION', timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        sessions[xnat_interface_config_path] = (server, session)
+        with _open_sessions_lock:
+            _open_sessions.append((server, session))
+
+    return sessions[xnat_interface_config_path]
+
+def close_thread_sessions():
+    """
+    Logs out (DELETE /data/JSESSION) and closes every session opened by get_thread_session.
+    Call this once the worker threads are done with them.
+    """
+    with _open_sessions_lock:
+        while _open_sessions:
+            server, session = _open_sessions.pop()
+            try:
+                session.delete(f'{server}/data/JSESSION', timeout=REQUEST_TIMEOUT)
+            except Exception as e:
+                print(f"Error logging out of {server}: {e}", flush=True)
+            finally:
+                session.close()
+
+# --- On-disk cache of file stats from previous runs ---
+def open_stats_cache(cache_path):
+    """
+    Opens (creating if needed) the sqlite cache of experiment file statistics.
+    The connection is only used from the main thread.
+    """
+    cache = sqlite3.connect(cache_path)
+    cache.execute("""CREATE TABLE IF NOT EXISTS experiment_file_stats (
+                         experiment_id TEXT PRIMARY KEY,
+                         last_modified TEXT NOT NULL,
+                         num_files INTEGER NOT NULL,
+                         total_size_bytes INTEGER NOT NULL)""")
+    return cache
+
+def get_cached_stats(cache, experiment_id, last_modified):
+    """
+    Returns (num_files, total_size_bytes) if this experiment was cached with the same last_modified, else None.
+    """
+    if not last_modified:
+        return None
+    return cache.execute('SELECT num_files, total_size_bytes FROM experiment_file_stats WHERE experiment_id = ? AND last_modified = ?',
+                         (experiment_id, last_modified)).fetchone()
+
+def cache_stats(cache, experiment_id, last_modified, num_files, total_size_bytes):
+    """
+    Records the file statistics of an experiment, replacing any entry from an older last_modified.
+    """
+    if not last_modified:
+        return
+    cache.execute('INSERT OR REPLACE INTO experiment_file_stats VALUES (?, ?, ?, ?)',
+                  (experiment_id, last_modified, num_files, total_size_bytes))
+
 # --- Worker Function to get file stats for a single experiment ---
-def get_experiment_file_stats(xnat_interface_config_path, xnat2_config, experiment_id, project_id, subject_id, subject_label):
+def get_experiment_file_stats(xnat_interface_config_path, xnat2_experiments, experiment_id, experiment_label, project_id, subject_id, subject_label):
     """
-    Connects to XNAT, fetches file statistics (count and total size) for a single experiment
+    Fetches file statistics (count and total size) for a single experiment
     by iterating through its scans and their resources.
-    Each worker thread will create its own pyxnat.Interface for thread safety.
+    XNAT2 existence is looked up in xnat2_experiments, the set of (project, label) pairs on XNAT2.
+    Requests go through the calling thread's persistent requests.Session (see get_thread_session).
     """
-    thread_xnat_interface = None
     try:
-        thread_xnat_interface = Interface(config=xnat_interface_config_path)
-        
+        server, xnat1_session = get_thread_session(xnat_interface_config_path)
+
         total_experiment_files = 0
         total_experiment_size_bytes = 0
 
         # Step 1: Get all scans for this experiment
         # API call: /data/experiments/{experiment_id}/scans
-        response = thread_xnat_interface.get(f'/data/experiments/{experiment_id}/scans')
-        assert response.ok, f"Failed to get scans for experiment {experiment_id}"
+        response = xnat1_session.get(f'{server}/data/experiments/{experiment_id}/scans?format=json', timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
         scans_list = response.json()['ResultSet']['Result']
 
         # Step 2: For each scan, get its resources and aggregate file stats
@@ -42,24 +143,17 @@ def get_experiment_file_stats(xnat_interface_config_path, xnat2_config, experime
             # API call: /data/experiments/{experiment_id}/scans/{scan_id}/resources
             # scan['URI'] provides the URI for the scan: /data/experiments/{experiment_id}/scans/{scan_id}
             URI = scan['URI']
-            resources_resp = thread_xnat_interface.get(f'{URI}/resources')
-            assert resources_resp.ok, f"Failed to get resources for scan {scan['ID']} in experiment {experiment_id}"    
+            resources_resp = xnat1_session.get(f'{server}{URI}/resources?format=json', timeout=REQUEST_TIMEOUT)
+            resources_resp.raise_for_status()
             resources_list = resources_resp.json()['ResultSet']['Result']
 
             # Sum 'file_size' and 'file_count' from the resources of this scan
-            # Handle potential NaN values if some resources don't have these fields
-            total_experiment_files += sum((int(res.get('file_count', 0)) for res in resources_list))
-            total_experiment_size_bytes += sum((int(res.get('file_size', 0)) for res in resources_list))
-
-        # step 3: create a mapping of experiment IDs --> experiment Labels
-        resp = thread_xnat_interface.get('/data/experiments?columns=ID,label')
-        list_of_dicts = resp.json()['ResultSet']['Result']
-        id_to_label_map = {d["ID"]: d["label"] for d in list_of_dicts}
-        experiment_label = id_to_label_map.get(experiment_id, 'Label Not Found')
+            # Handle missing or empty values if some resources don't have these fields
+            total_experiment_files += sum((int(res.get('file_count') or 0) for res in resources_list))
+            total_experiment_size_bytes += sum((int(res.get('file_size') or 0) for res in resources_list))
 
-        # step 4: Does this experiment exist in XNAT2?
-        xnat2_interface = Interface(config=xnat2_config)
-        xnat2_exists = xnat2_interface.select.experiment(experiment_label).exists()
+        # step 3: Does this experiment exist in XNAT2?
+        xnat2_exists = (project_id, experiment_label) in xnat2_experiments
 
         return {
             'project_id': project_id,
@@ -83,17 +177,6 @@ def get_experiment_file_stats(xnat_interface_config_path, xnat2_config, experime
             'total_size_bytes': None,
             'error': str(e)
         }
-    finally:
-        if thread_xnat_interface:
-            try:
-                thread_xnat_interface.disconnect()
-            except Exception as e:
-                print(f"Error disconnecting XNAT1 interface for experiment {experiment_id}: {e}", flush=True)
-        if xnat2_interface:
-            try:
-                xnat2_interface.disconnect()
-            except Exception as e:
-                print(f"Error disconnecting XNAT2 interface for experiment {experiment_id}: {e}", flush=True)
 
 def main():
 
@@ -105,57 +188,137 @@ def main():
     search_object = xnat1.select('xnat:mrSessionData', ['xnat:mrSessionData/PROJECT','xnat:mrSessionData/SUBJECT_ID', 'xnat:mrSessionData/SESSION_ID', 'xnat:mrSessionData/SUBJECT_LABEL'])
     experiments_table = search_object.all()
 
+    # create a mapping of experiment IDs --> experiment Labels, once for all experiments
+    list_of_dicts = xnat1.get('/data/experiments?columns=ID,label').json()['ResultSet']['Result']
+    id_to_label_map = {d["ID"]: d["label"] for d in list_of_dicts}
+
+    # last_modified is only needed by the stats cache. It is fetched in a separate search so that
+    # a server rejecting the LAST_MODIFIED field disables the cache instead of stopping the report.
+    last_modified_map = {}
+    if USE_STATS_CACHE:
+        try:
+            last_modified_table = xnat1.select('xnat:mrSessionData', ['xnat:mrSessionData/SESSION_ID', 'xnat:mrSessionData/LAST_MODIFIED']).all()
+            last_modified_map = {row['session_id']: row.get('last_modified') for row in last_modified_table}
+        except Exception as e:
+            print(f"Could not read xnat:mrSessionData/LAST_MODIFIED; running without the stats cache: {e}", flush=True)
+
     xnat1.disconnect()
 
+    # collect the (project, label) of every experiment already on xnat2, so existence is a set lookup.
+    # Labels are only unique within a project (e.g. 211209RR is in both Somers_3sense and Somers_EMP),
+    # so the project is part of the key. This assumes projects keep their IDs when migrated to xnat2.
+    xnat2 = Interface(config=XNAT2_CFG)
+    xnat2_experiments = frozenset((d['project'], d['label']) for d in xnat2.get('/data/experiments?columns=project,label').json()['ResultSet']['Result'])
+    xnat2.disconnect()
+
     experiment_tasks = []
     for row in experiments_table:
         experiment_id = row['session_id']
+        experiment_label = id_to_label_map.get(experiment_id, 'Label Not Found')
         project_id = row['project']
         subject_id = row['subject_id']
         subject_label = row['subject_label']
-        experiment_tasks.append((experiment_id, project_id, subject_id, subject_label))
+        last_modified = last_modified_map.get(experiment_id)
+        experiment_tasks.append((experiment_id, experiment_label, project_id, subject_id, subject_label, last_modified))
+
+    # the search table and label map are no longer needed once the tasks are built
+    del experiments_table, id_to_label_map, last_modified_map
+
+    # group tasks by project so consecutive requests from a worker stay within one project
+    experiment_tasks.sort(key=lambda task: task[2])
 
     print(f"Found {len(experiment_tasks)} experiments to process for file statistics.")
-    print(f"Processing experiment file stats using {MAX_WORKERS} worker threads concurrently...")
 
-    results = []
+    # Rows are written to a temporary CSV as each experiment completes; only running totals are kept in memory.
+    # The previous report is only replaced once the pool has finished and produced rows.
+    output_filename = "xnat_experiment_file_stats_with_scans.csv"
+    temp_filename = output_filename + '.tmp'
+    fieldnames = ['project_id', 'subject_id', 'subject_label', 'experiment_id', 'experiment_label', 'xnat2_exists', 'num_files', 'total_size_bytes']
+    successful_count = 0
+    total_estimated_files = 0
+    total_estimated_size_bytes = 0
+
+    cache = open_stats_cache(CACHE_DB) if USE_STATS_CACHE else None
+
     processed_count = 0
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit tasks and map experiment_tasks to get_experiment_file_stats
-        futures = {executor.submit(get_experiment_file_stats, XNAT1_CFG, XNAT2_CFG, experiment_id, project_id, subject_id, subject_label): (experiment_id, project_id, subject_id, subject_label)
-                   for experiment_id, project_id, subject_id, subject_label in experiment_tasks}
-        
+    with open(temp_filename, 'w', newline='') as output_file, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        writer = csv.DictWriter(output_file, fieldnames=fieldnames)
+        writer.writeheader()
+
+        # With the stats cache on, experiments unchanged since the last run are written straight from it.
+        # XNAT2 existence is not cached, since it changes as the migration progresses.
+        pending_tasks = experiment_tasks
+        if cache is not None:
+            pending_tasks = []
+            for task in experiment_tasks:
+                experiment_id, experiment_label, project_id, subject_id, subject_label, last_modified = task
+                cached = get_cached_stats(cache, experiment_id, last_modified)
+                if cached is None:
+                    pending_tasks.append(task)
+                    continue
+                num_files, total_size_bytes = cached
+                writer.writerow({
+                    'project_id': project_id,
+                    'subject_id': subject_id,
+                    'subject_label': subject_label,
+                    'experiment_id': experiment_id,
+                    'experiment_label': experiment_label,
+                    'xnat2_exists': (project_id, experiment_label) in xnat2_experiments,
+                    'num_files': num_files,
+                    'total_size_bytes': total_size_bytes
+                })
+                successful_count += 1
+                total_estimated_files += num_files
+                total_estimated_size_bytes += total_size_bytes
+            print(f"{len(experiment_tasks) - len(pending_tasks)} experiments unchanged since the last run were read from {CACHE_DB}.")
+        print(f"Processing file stats for {len(pending_tasks)} experiments using {MAX_WORKERS} worker threads concurrently...")
+
+        # Submit tasks and map pending_tasks to get_experiment_file_stats
+        futures = {executor.submit(get_experiment_file_stats, XNAT1_CFG, xnat2_experiments, experiment_id, experiment_label, project_id, subject_id, subject_label): (experiment_id, experiment_label, project_id, subject_id, subject_label, last_modified)
+                   for experiment_id, experiment_label, project_id, subject_id, subject_label, last_modified in pending_tasks}
+
         for future in as_completed(futures):
             processed_count += 1
-            exp_id_current, _, _, _ = futures[future] # Get experiment ID for logging progress
+            # Pop the finished future so its result can be freed once the row is written
+            exp_id_current, _, _, _, _, last_modified = futures.pop(future) # Get experiment ID for logging progress
             try:
                 result = future.result()
-                results.append(result)
-                if processed_count % 10 == 0 or processed_count == len(experiment_tasks): # Print every 5 tasks, and always print the final one
-                    print(f"Processed {processed_count}/{len(experiment_tasks)} experiments. Current: {exp_id_current}", flush=True)
+                if 'error' not in result:
+                    writer.writerow(result)
+                    if cache is not None:
+                        cache_stats(cache, exp_id_current, last_modified, result['num_files'], result['total_size_bytes'])
+                    successful_count += 1
+                    total_estimated_files += result['num_files']
+                    total_estimated_size_bytes += result['total_size_bytes']
+                if processed_count % 10 == 0 or processed_count == len(pending_tasks): # Print every 10 tasks, and always print the final one
+                    output_file.flush()
+                    if cache is not None:
+                        cache.commit()
+                    print(f"Processed {processed_count}/{len(pending_tasks)} experiments. Current: {exp_id_current}", flush=True)
             except Exception as e:
                 print(f"A task for experiment {exp_id_current} failed to complete: {e}", flush=True)
-                results.append(None) # Append None or an error dict for failed tasks
+
+    # the pool has shut down, so no worker is still using its session
+    close_thread_sessions()
+
+    if cache is not None:
+        cache.commit()
+        cache.close()
+
+    if successful_count:
+        os.replace(temp_filename, output_filename)
+    else:
+        os.remove(temp_filename)
 
     end_time = time.time()
     print(f"\nFinished processing {len(experiment_tasks)} experiments in {end_time - start_time:.2f} seconds.")
 
-    successful_results = [r for r in results if r is not None and 'error' not in r]
+    if successful_count:
+        total_estimated_size_gb = total_estimated_size_bytes / (1024**3)
 
-    if successful_results:
-        df_results = pd.DataFrame(successful_results)
-        print("\nSample Results:")
-        print(df_results.head())
-        
-        total_estimated_files = df_results['num_files'].sum()
-        total_estimated_size_gb = df_results['total_size_bytes'].sum() / (1024**3)
-        
         print(f"\nTotal estimated files across all successful experiments: {total_estimated_files}")
         print(f"Total estimated size across all successful experiments: {total_estimated_size_gb:.2f} GB")
-        
-        output_filename = "xnat_experiment_file_stats_with_scans.csv"
-        df_results.to_csv(output_filename, index=False)
-        print(f"Detailed results saved to {output_filename}")
+        print(f"Detailed results for {successful_count} experiments saved to {output_filename}")
     else:
         print("No successful results to display or save.")
 
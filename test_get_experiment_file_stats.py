@@ -1,6 +1,6 @@
 from pyxnat import Interface
 import os
-from migration_report import get_experiment_file_stats
+from migration_report import get_experiment_file_stats, close_thread_sessions
 import time
 
 def test_get_experiment_file_stats():
@@ -10,10 +10,14 @@ def test_get_experiment_file_stats():
     # file in their home directory.
     xnat_cfg = os.path.expanduser('~/xnat.cfg')
     xnat2_cfg = os.path.expanduser('~/xnat2.cfg')
+    xnat2 = Interface(config=xnat2_cfg)
+    xnat2_experiments = frozenset((d['project'], d['label']) for d in xnat2.get('/data/experiments?columns=project,label').json()['ResultSet']['Result'])
+    xnat2.disconnect()
     
     start_time = time.time()
-    stats = get_experiment_file_stats(xnat_cfg, xnat2_cfg, 'CNC_Archive_E02462', 'BASS', 'CNC_Archive_S02250', '230814_BASSptp024')
+    stats = get_experiment_file_stats(xnat_cfg, xnat2_experiments, 'CNC_Archive_E02462', '230814_BASSptp024', 'BASS', 'CNC_Archive_S02250', '230814_BASSptp024')
     end_time = time.time()
+    close_thread_sessions()
 
     elapsed_time = end_time - start_time
     print(f"Function executed in {elapsed_time:.4f} seconds")
@@ -0,0 +1,35 @@
+from migration_report import open_stats_cache, get_cached_stats, cache_stats
+
+def test_cached_stats_hit_on_matching_last_modified():
+    """Test that cached stats are returned when last_modified matches."""
+    cache = open_stats_cache(':memory:')
+    cache_stats(cache, 'CNC_Archive_E02462', '2023-08-14 10:00:00.0', 3064, 2159465250)
+
+    assert get_cached_stats(cache, 'CNC_Archive_E02462', '2023-08-14 10:00:00.0') == (3064, 2159465250)
+
+def test_cached_stats_miss_after_last_modified_changes():
+    """Test that an experiment modified since it was cached is not served from the cache."""
+    cache = open_stats_cache(':memory:')
+    cache_stats(cache, 'CNC_Archive_E02462', '2023-08-14 10:00:00.0', 3064, 2159465250)
+
+    assert get_cached_stats(cache, 'CNC_Archive_E02462', '2024-01-01 09:30:00.0') is None
+
+def test_cache_stats_replaces_older_entry():
+    """Test that caching a newer last_modified overwrites the previous entry."""
+    cache = open_stats_cache(':memory:')
+    cache_stats(cache, 'CNC_Archive_E02462', '2023-08-14 10:00:00.0', 3064, 2159465250)
+    cache_stats(cache, 'CNC_Archive_E02462', '2024-01-01 09:30:00.0', 3100, 2200000000)
+
+    assert get_cached_stats(cache, 'CNC_Archive_E02462', '2023-08-14 10:00:00.0') is None
+    assert get_cached_stats(cache, 'CNC_Archive_E02462', '2024-01-01 09:30:00.0') == (3100, 2200000000)
+    assert cache.execute('SELECT COUNT(*) FROM experiment_file_stats').fetchone() == (1,)
+
+def test_cache_stats_skips_missing_last_modified():
+    """Test that experiments without a last_modified are never stored or served."""
+    cache = open_stats_cache(':memory:')
+    cache_stats(cache, 'CNC_Archive_E02462', '', 3064, 2159465250)
+    cache_stats(cache, 'CNC_Archive_E02819', None, 3064, 2159753454)
+
+    assert cache.execute('SELECT COUNT(*) FROM experiment_file_stats').fetchone() == (0,)
+    assert get_cached_stats(cache, 'CNC_Archive_E02462', '') is None
+    assert get_cached_stats(cache, 'CNC_Archive_E02819', None) is None